@@ -35,7 +35,16 @@ np.seterr(divide='ignore', invalid='ignore')
 from sklearn.neural_network import MLPClassifier
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
-from scipy.signal import convolve2d
+from sklearn.model_selection import train_test_split
+from scipy.ndimage import uniform_filter, distance_transform_edt
+from scipy.signal import fftconvolve
+
+#optional fast inference of the fitted classifier
+try:
+    from skl2onnx import to_onnx
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 #crf
 import pydensecrf.densecrf as dcrf
@@ -44,11 +53,17 @@ from pydensecrf.utils import create_pairwise_bilateral, unary_from_softmax, unar
 #utility
 from tempfile import TemporaryFile
 from joblib import Parallel, delayed
-import io, os, logging, psutil, itertools
+import io, os, logging, psutil, functools
 # from datetime import datetime
-from skimage import filters, feature, img_as_float32
+from skimage import filters, img_as_float32
 from skimage.transform import resize
 
+# rows of features per predict_proba call; the (rows, 100) float32 hidden layer
+# activations then stay within a few MB (about half of a typical L3 cache)
+PREDICT_CHUNK_SIZE = 8192
+# rows of training data per MLP partial_fit call
+TRAIN_BATCH_SIZE = 10000
+
 ##========================================================
 def fromhex(n):
     """ hexadecimal to integer """
@@ -61,9 +76,12 @@ def rescale(dat,
     '''
     rescales an input dat between mn and mx
     '''
-    m = min(dat.flatten())
-    M = max(dat.flatten())
-    return (mx-mn)*(dat-m)/(M-m)+mn
+    m = dat.min()
+    M = dat.max()
+    out = np.subtract(dat, m, dtype=np.promote_types(dat.dtype, np.float32))
+    out *= (mx-mn)/(M-m)
+    out += mn
+    return out
 
 ##====================================
 def standardize(img):
@@ -73,42 +91,87 @@ def standardize(img):
     '''
     #
     N = np.shape(img)[0] * np.shape(img)[1]
-    s = np.maximum(np.std(img), 1.0/np.sqrt(N))
-    m = np.mean(img)
-    img = (img - m) / s
-    img = rescale(img, 0, 1)
-    del m, s, N
+    # one float32 copy, standardized and rescaled to [0, 1] in place
+    img = img.astype(np.float32, copy=True)
+    img -= img.mean()
+    img *= 1.0/max(img.std(), 1.0/np.sqrt(N))
+    lo, hi = img.min(), img.max()
+    img -= lo
+    img *= 1.0/(hi-lo)
+    del lo, hi, N
 
     if np.ndim(img)!=3:
-        img = np.dstack((img,img,img))
+        # read-only view, no need to store three copies of the same band
+        img = np.broadcast_to(img[...,None], img.shape+(3,))
 
     return img
 
 # ##========================================================
 def inpaint_nans(im):
     '''
-    quick and dirty nan inpainting using kernel trick
+    quick and dirty nan inpainting using nearest valid pixels
     '''
-    ipn_kernel = np.array([[1,1,1],[1,0,1],[1,1,1]]) # kernel for inpaint_nans
     nans = np.isnan(im)
-    while np.sum(nans)>0:
-        im[nans] = 0
-        vNeighbors = convolve2d((nans==False),ipn_kernel,mode='same',boundary='symm')
-        im2 = convolve2d(im,ipn_kernel,mode='same',boundary='symm')
-        im2[vNeighbors>0] = im2[vNeighbors>0]/vNeighbors[vNeighbors>0]
-        im2[vNeighbors==0] = np.nan
-        im2[(nans==False)] = im[(nans==False)]
-        im = im2
-        nans = np.isnan(im)
+    if (not nans.any()) or nans.all():
+        return im
+    # indices of the nearest non-nan pixel, for every pixel, in one pass
+    idx = distance_transform_edt(nans, return_indices=True, return_distances=False)
+    im = im[tuple(idx)]
+    # one 3x3 smoothing pass over the filled region approximates the old diffusion fill
+    im[nans] = uniform_filter(im, size=3, mode='reflect')[nans]
     return im
 
 
+##========================================================
+def _crf_scale(shape, crf_downsample_factor):
+    """
+    Bilateral colour scale and effective downsample factor used by the CRF for an image of this shape
+    """
+    scale = 1+(5 * (np.array(shape).max() / 3000))
+    # bound the cost of the CRF by working on at most ~1024 pixels along the longest side
+    crf_downsample_factor = max(crf_downsample_factor, int(np.ceil(max(shape[0],shape[1])/1024)))
+    return scale, crf_downsample_factor
+
+##========================================================
+def _build_bilateral(img, crf_theta_slider_value, crf_downsample_factor):
+    """
+    Bilateral pairwise features for the image as downsampled by crf_refine and
+    crf_refine_from_integer_labels, so that they can be built once and passed to both
+    """
+    scale, crf_downsample_factor = _crf_scale(img.shape, crf_downsample_factor)
+    img = img[::crf_downsample_factor,::crf_downsample_factor, :]
+    return create_pairwise_bilateral(
+                          sdims=(crf_theta_slider_value, crf_theta_slider_value),
+                          schan=(scale,scale,scale),
+                          img=img,
+                          chdim=2)
+
+##========================================================
+def _crf_inference(d, max_iter=10, tol=1e-3):
+    """
+    Mean-field inference on a DenseCRF, stepped manually and stopped early
+    once the mean absolute change in the marginals falls below ``tol``
+    """
+    Q, tmp1, tmp2 = d.startInference()
+    prev = None
+    for i in range(max_iter):
+        d.stepInference(Q, tmp1, tmp2)
+        arr = np.array(Q)
+        if prev is not None and np.abs(arr-prev).mean() < tol:
+            logging.info('CRF inference converged after %i iterations' % (i+1))
+            break
+        prev = arr
+    return np.array(Q)
+
 ##========================================================
 def crf_refine_from_integer_labels(label,
     img,n,
     crf_theta_slider_value,
     crf_mu_slider_value,
-    crf_downsample_factor): #gt_prob
+    crf_downsample_factor,
+    feats=None,
+    max_iter=10,
+    tol=1e-3): #gt_prob
     """
     "crf_refine(label, img)"
     This function refines a label image based on an input label image and the associated image
@@ -116,7 +179,9 @@ def crf_refine_from_integer_labels(label,
     INPUTS:
         * label [ndarray]: label image 2D matrix of integers
         * image [ndarray]: image 3D matrix of integers
-    OPTIONAL INPUTS: None
+    OPTIONAL INPUTS: feats [ndarray]: precomputed bilateral pairwise features for the downsampled image
+                     max_iter [int]: maximum number of mean-field iterations
+                     tol [float]: stop once the mean absolute change in the marginals is below this
     GLOBAL INPUTS: None
     OUTPUTS: label [ndarray]: label image 2D matrix of integers
     """
@@ -127,9 +192,11 @@ def crf_refine_from_integer_labels(label,
 
     # label = label.reshape(Horig,Worig,l_unique)
 
-    scale = 1+(5 * (np.array(img.shape).max() / 3000))
-    logging.info('CRF scale: %f' % (scale))
+    if feats is None:
+        feats = _build_bilateral(img, crf_theta_slider_value, crf_downsample_factor)
 
+    scale, crf_downsample_factor = _crf_scale(img.shape, crf_downsample_factor)
+    logging.info('CRF scale: %f' % (scale))
     logging.info('CRF downsample factor: %f' % (crf_downsample_factor))
     logging.info('CRF theta parameter: %f' % (crf_theta_slider_value))
     logging.info('CRF mu parameter: %f' % (crf_mu_slider_value))
@@ -158,28 +225,22 @@ def crf_refine_from_integer_labels(label,
                  compat=3,
                  kernel=dcrf.DIAG_KERNEL,
                  normalization=dcrf.NORMALIZE_SYMMETRIC)
-    feats = create_pairwise_bilateral(
-                          sdims=(crf_theta_slider_value, crf_theta_slider_value),
-                          schan=(scale,scale,scale),
-                          img=img,
-                          chdim=2)
-
     d.addPairwiseEnergy(feats, compat=crf_mu_slider_value, kernel=dcrf.DIAG_KERNEL,normalization=dcrf.NORMALIZE_SYMMETRIC) #260
 
     logging.info('CRF feature extraction complete ... inference starting')
 
-    Q = d.inference(10)
+    Q = _crf_inference(d, max_iter, tol)
     result = np.argmax(Q, axis=0).reshape((H, W)).astype(np.uint8) +1
     logging.info('CRF inference made')
 
     # uniq = np.unique(result.flatten())
 
-    result = resize(result, (Horig, Worig), order=0, anti_aliasing=False) #True)
-    result = rescale(result, 1, l_unique).astype(np.uint8)
+    # nearest-neighbour upsampling (order=0) keeps the integer labels as they are
+    result = resize(result, (Horig, Worig), order=0, preserve_range=True, anti_aliasing=False).astype(np.uint8)
 
     # result = rescale(result, orig_mn, orig_mx).astype(np.uint8)
 
-    logging.info('label resized and rescaled ... CRF from labels post-processing complete')
+    logging.info('label resized ... CRF from labels post-processing complete')
 
     return result, l_unique
 
@@ -188,7 +249,10 @@ def crf_refine(label,
     img,n,
     crf_theta_slider_value,
     crf_mu_slider_value,
-    crf_downsample_factor): #gt_prob
+    crf_downsample_factor,
+    feats=None,
+    max_iter=10,
+    tol=1e-3): #gt_prob
     """
     "crf_refine(label, img)"
     This function refines a label image based on an input label image and the associated image
@@ -196,7 +260,9 @@ def crf_refine(label,
     INPUTS:
         * label [ndarray]: label image 2D matrix of integers
         * image [ndarray]: image 3D matrix of integers
-    OPTIONAL INPUTS: None
+    OPTIONAL INPUTS: feats [ndarray]: precomputed bilateral pairwise features for the downsampled image
+                     max_iter [int]: maximum number of mean-field iterations
+                     tol [float]: stop once the mean absolute change in the marginals is below this
     GLOBAL INPUTS: None
     OUTPUTS: label [ndarray]: label image 2D matrix of integers
     """
@@ -207,9 +273,11 @@ def crf_refine(label,
 
     label = label.reshape(Horig,Worig,l_unique)
 
-    scale = 1+(5 * (np.array(img.shape).max() / 3000))
-    logging.info('CRF scale: %f' % (scale))
+    if feats is None:
+        feats = _build_bilateral(img, crf_theta_slider_value, crf_downsample_factor)
 
+    scale, crf_downsample_factor = _crf_scale(img.shape, crf_downsample_factor)
+    logging.info('CRF scale: %f' % (scale))
     logging.info('CRF downsample factor: %f' % (crf_downsample_factor))
     logging.info('CRF theta parameter: %f' % (crf_theta_slider_value))
     logging.info('CRF mu parameter: %f' % (crf_mu_slider_value))
@@ -238,81 +306,131 @@ def crf_refine(label,
                  compat=3,
                  kernel=dcrf.DIAG_KERNEL,
                  normalization=dcrf.NORMALIZE_SYMMETRIC)
-    feats = create_pairwise_bilateral(
-                          sdims=(crf_theta_slider_value, crf_theta_slider_value),
-                          schan=(scale,scale,scale),
-                          img=img,
-                          chdim=2)
-
     d.addPairwiseEnergy(feats, compat=crf_mu_slider_value, kernel=dcrf.DIAG_KERNEL,normalization=dcrf.NORMALIZE_SYMMETRIC) #260
 
     logging.info('CRF feature extraction complete ... inference starting')
 
-    Q = d.inference(10)
+    Q = _crf_inference(d, max_iter, tol)
     result = np.argmax(Q, axis=0).reshape((H, W)).astype(np.uint8) +1
     logging.info('CRF inference made')
 
     # uniq = np.unique(result.flatten())
 
-    result = resize(result, (Horig, Worig), order=0, anti_aliasing=False) #True)
-    result = rescale(result, 1, l_unique).astype(np.uint8)
+    # nearest-neighbour upsampling (order=0) keeps the integer labels as they are
+    result = resize(result, (Horig, Worig), order=0, preserve_range=True, anti_aliasing=False).astype(np.uint8)
 
     # result = rescale(result, orig_mn, orig_mx).astype(np.uint8)
 
-    logging.info('label resized and rescaled ... CRF from softmax post-processing complete')
+    logging.info('label resized ... CRF from softmax post-processing complete')
 
     return result, l_unique
 
+##========================================================
+def _gaussian(img, sigma, truncate=3.0):
+    """
+    Gaussian blur of a 2d float32 image, with the kernel truncated at ``truncate`` sigma.
+    Wide kernels (sigma > 6) are applied as an FFT convolution of the edge-padded image,
+    which matches the 'nearest' boundary mode of filters.gaussian
+    """
+    if sigma > 6:
+        r = int(truncate * sigma + 0.5)
+        x = np.arange(-r, r+1, dtype=np.float32)
+        k = np.exp(-0.5 * (x / sigma)**2)
+        k /= k.sum()
+        return fftconvolve(np.pad(img, r, mode='edge'), np.outer(k, k), mode='valid').astype(np.float32, copy=False)
+    return filters.gaussian(img, sigma=sigma, truncate=truncate, preserve_range=True, channel_axis=None)
+
+##========================================================
+@functools.lru_cache(maxsize=None)
+def _location_feature(H, W, sigma):
+    """Location feature for an image of shape (H, W); depends only on shape and ``sigma``,
+    so it is computed once and shared between channels (extract_features clears the cache when done)
+    """
+    gx,gy = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32))
+    gx = _gaussian(gx, sigma)
+    gy = _gaussian(gy, sigma)
+
+    loc = np.sqrt(gx**2 + gy**2) #use polar radius of pixel locations as cartesian coordinates
+    del gx, gy
+    # normalised by the image diagonal to [0,1]: in pixel units the radius would lose precision
+    # in float16 storage on large images (and overflow to inf past 65504 pixels)
+    loc *= 1.0/np.hypot(H, W)
+
+    loc.setflags(write=False)
+    return loc
+
+##========================================================
+def _hessian_eigvals(H_elems, out):
+    """
+    Eigenvalues of the 2d Hessian [Hrr, Hrc, Hcc] in closed form, largest first,
+    written into out[0] and out[1]: (Hrr+Hcc)/2 +/- sqrt(((Hrr-Hcc)/2)**2 + Hrc**2)
+    """
+    Hrr, Hrc, Hcc = H_elems
+    mean = Hrr + Hcc
+    mean *= 0.5
+    disc = Hrr - Hcc
+    disc *= 0.5
+    disc *= disc
+    disc += Hrc * Hrc
+    np.sqrt(disc, out=disc)
+    np.add(mean, disc, out=out[0])
+    np.subtract(mean, disc, out=out[1])
+    return out
+
+##========================================================
+def _n_features_sigma(intensity=True, edges=True, texture=True):
+    """Number of feature planes features_sigma makes for one sigma (location, intensity, edges, 2 Hessian eigenvalues)
+    """
+    return 1 + int(intensity) + int(edges) + 2*int(texture)
+
 ##========================================================
 def features_sigma(img,
     sigma,
     intensity=True,
     edges=True,
-    texture=True):
-    """Features for a single value of the Gaussian blurring parameter ``sigma``
+    texture=True,
+    out=None,
+    loc=None):
+    """Features for a single value of the Gaussian blurring parameter ``sigma``,
+    written into consecutive planes of ``out`` (allocated if not given).
+    ``loc`` is the location feature, looked up from the cache if not given
     """
+    if out is None:
+        out = np.empty((_n_features_sigma(intensity, edges, texture),)+img.shape, dtype=np.float32)
+    k = 0
 
-    features = []
-
-    gx,gy = np.meshgrid(np.arange(img.shape[1]), np.arange(img.shape[0]))
-    gx = filters.gaussian(gx, sigma)
-    gy = filters.gaussian(gy, sigma)
-
-    features.append(np.sqrt(gx**2 + gy**2)) #use polar radius of pixel locations as cartesian coordinates
-
-    del gx, gy
+    if loc is None:
+        loc = _location_feature(img.shape[0], img.shape[1], sigma)
+    np.copyto(out[k], loc); k += 1
 
     logging.info('Location features extracted using sigma= %f' % (sigma))
 
-    img_blur = filters.gaussian(img, sigma)
+    if intensity or edges or texture:
+        img_blur = _gaussian(img, sigma)
 
     if intensity:
-        features.append(img_blur)
+        np.copyto(out[k], img_blur); k += 1
 
     logging.info('Intensity features extracted using sigma= %f' % (sigma))
 
     if edges:
-        features.append(filters.sobel(img_blur))
+        np.copyto(out[k], filters.sobel(img_blur)); k += 1
 
     logging.info('Edge features extracted using sigma= %f' % (sigma))
 
     if texture:
-        H_elems = [
-            np.gradient(np.gradient(img_blur)[ax0], axis=ax1)
-            for ax0, ax1 in itertools.combinations_with_replacement(range(img.ndim), 2)
-        ]
+        # Hessian of the blurred image, from a single first-derivative pass (Hcr == Hrc)
+        gr, gc = np.gradient(img_blur)
+        H_elems = [np.gradient(gr, axis=0), np.gradient(gr, axis=1), np.gradient(gc, axis=1)]
+        del gr, gc
 
-        eigvals = feature.hessian_matrix_eigvals(H_elems)
+        _hessian_eigvals(H_elems, out[k:k+2]); k += 2
         del H_elems
 
-        for eigval_mat in eigvals:
-            features.append(eigval_mat)
-        del eigval_mat
-
     logging.info('Texture features extracted using sigma= %f' % (sigma))
     logging.info('Image features extracted using sigma= %f' % (sigma))
 
-    return features
+    return out
 
 ##========================================================
 def extract_features_2d(
@@ -323,9 +441,13 @@ def extract_features_2d(
     edges=True,
     texture=True,
     sigma_min=0.5,
-    sigma_max=16
+    sigma_max=16,
+    out=None,
+    backend='threading',
 ):
     """Features for a single channel image. ``img`` can be 2d or 3d.
+    Features for all sigmas are written into ``out`` (allocated if not given)
+    using the joblib ``backend`` ('threading', or a process backend such as 'loky')
     """
     logging.info('Extracting features from channel %i' % (dim))
 
@@ -340,27 +462,30 @@ def extract_features_2d(
         endpoint=True,
     )
 
-    if (psutil.virtual_memory()[0]>10000000000) & (psutil.virtual_memory()[2]<50): #>10GB and <50% utilization
-        logging.info('Extracting features in parallel')
-        logging.info('Total RAM: %i' % (psutil.virtual_memory()[0]))
-        logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
-
-        all_results = Parallel(n_jobs=-2, verbose=0)(delayed(features_sigma)(img, sigma, intensity=intensity, edges=edges, texture=texture) for sigma in sigmas)
-    else:
+    logging.info('Extracting features in parallel (%s backend)' % (backend))
+    logging.info('Total RAM: %i' % (psutil.virtual_memory()[0]))
+    logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
 
-        logging.info('Extracting features in series')
-        logging.info('Total RAM: %i' % (psutil.virtual_memory()[0]))
-        logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
+    k = _n_features_sigma(intensity, edges, texture)
+    if out is None:
+        out = np.empty((len(sigmas)*k,)+img.shape, dtype=np.float32)
 
-        n_sigmas = len(sigmas)
-        all_results = [
-            features_sigma(img, sigma, intensity=intensity, edges=edges, texture=texture)
-            for sigma in sigmas
-        ]
+    if backend=='threading':
+        # the skimage/scipy filters run in compiled code, so threads share img and out without copying
+        Parallel(n_jobs=-2, verbose=0, backend='threading')(delayed(features_sigma)(img, sigma, intensity=intensity, edges=edges, texture=texture, out=out[i*k:(i+1)*k]) for i, sigma in enumerate(sigmas))
+    else:
+        # joblib hands large arrays to worker processes as a shared read-only memmap, so img is
+        # not pickled once per worker. The location planes come from this process's cache
+        # (which extract_features clears), and each worker's planes are copied into out as
+        # they arrive rather than collected for all sigmas first
+        results = Parallel(n_jobs=-2, verbose=0, backend=backend, return_as='generator')(delayed(features_sigma)(img, sigma, intensity=intensity, edges=edges, texture=texture, loc=_location_feature(img.shape[0], img.shape[1], sigma)) for sigma in sigmas)
+        for i, result in enumerate(results):
+            np.copyto(out[i*k:(i+1)*k], result)
+            del result
 
     logging.info('Features from channel %i for all scales' % (dim))
 
-    return list(itertools.chain.from_iterable(all_results))
+    return out
 
 ##========================================================
 def extract_features(
@@ -372,11 +497,31 @@ def extract_features(
     texture=True,
     sigma_min=0.5,
     sigma_max=16,
+    backend='threading',
 ):
-    """Features for a single- or multi-channel image.
+    """Features for a single- or multi-channel image, as an array of shape (n_feats, H, W).
+    If that needs less than a quarter of the available RAM it is held in memory,
+    otherwise features are written straight into a memory-mapped temporary file
     """
+    n_channels = img.shape[-1] if multichannel else 1
+    n_feats = n_sigmas * _n_features_sigma(intensity, edges, texture)
+    feats_shape = (n_channels * n_feats,) + img.shape[:2]
+    # half precision is plenty for features that are standardized before the MLP
+    dtype = np.float16
+
+    need = int(np.prod(feats_shape)) * np.dtype(dtype).itemsize
+    if need < 0.25 * psutil.virtual_memory().available:
+        # fits comfortably in RAM: skip writing everything to disk and reading it back
+        logging.info('Holding features in memory (%i bytes)' % (need))
+        outfile = None
+        fp = np.empty(feats_shape, dtype=dtype)
+    else:
+        logging.info('Memory mapping features to temporary file')
+        outfile = TemporaryFile()
+        fp = np.memmap(outfile, dtype=dtype, mode='w+', shape=feats_shape)
+
     if multichannel: 
-        all_results = (
+        for dim in range(n_channels):
             extract_features_2d(
                 dim,
                 img[..., dim],
@@ -386,12 +531,11 @@ def extract_features(
                 texture=texture,
                 sigma_min=sigma_min,
                 sigma_max=sigma_max,
+                out=fp[dim*n_feats:(dim+1)*n_feats],
+                backend=backend,
             )
-            for dim in range(img.shape[-1])
-        )
-        features = list(itertools.chain.from_iterable(all_results))
     else:
-        features = extract_features_2d(0,
+        extract_features_2d(0,
             img,
             n_sigmas,
             intensity=intensity,
@@ -399,38 +543,123 @@ def extract_features(
             texture=texture,
             sigma_min=sigma_min,
             sigma_max=sigma_max,
+            out=fp,
+            backend=backend,
         )
 
     logging.info('Feature extraction complete')
 
-    logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
-    logging.info('Memory mapping features to temporary file')
+    # the cached location planes are only shared between the channels of this image
+    _location_feature.cache_clear()
+
+    if outfile is None:
+        features = fp
+    else:
+        fp.flush()
+        del fp
+        logging.info('Features memory mapped features to temporary file: %s' % outfile)
+
+        #read back in again without using any memory
+        features = np.memmap(outfile, dtype=dtype, mode='r', shape=feats_shape)
 
-    features = memmap_feats(features)
     logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
 
     return features #np.array(features)
 
 ##========================================================
-def memmap_feats(features):
+def _fit_mlp(training_data,
+    training_labels,
+    unique_labels,
+    max_epochs=2000,
+    n_iter_no_change=10,
+    tol=1e-4):
     """
-    Memory-map data to a temporary file
+    Fit a StandardScaler + MLP pipeline on minibatches sampled from the training data.
+    One batch, stratified by class, is held out as a validation set for early stopping;
+    with fewer than 10 samples, training stops on the training loss instead
     """
-    features = np.array(features)
-    dtype = features.dtype
-    feats_shape = features.shape
-
-    outfile = TemporaryFile()
-    fp = np.memmap(outfile, dtype=dtype, mode='w+', shape=feats_shape)
-    fp[:] = features[:]
-    fp.flush()
-    del features
-    del fp
-    logging.info('Features memory mapped features to temporary file: %s' % outfile)
-
-    #read back in again without using any memory
-    features = np.memmap(outfile, dtype=dtype, mode='r', shape=feats_shape)
-    return features
+    # with alpha=1 the L2 penalty decays unused weights towards zero; denormal floats slow
+    # the float32 ONNX model down by an order of magnitude, so (with float64 training data)
+    # weights below the float32 range are flushed to zero
+    tiny = np.finfo(np.float32).tiny
+    rng = np.random.default_rng(1)
+    n = training_data.shape[0]
+    batch = min(TRAIN_BATCH_SIZE, n)
+
+    n_val = min(batch, n // 10)
+    if n_val > 0:
+        # stratified, as in MLPClassifier(early_stopping=True), so that rare classes are validated too
+        counts = np.unique(training_labels, return_counts=True)[1]
+        stratify = training_labels if (counts.min() > 1 and n_val >= counts.shape[0]) else None
+        train_ind, val_ind = train_test_split(np.arange(n), test_size=n_val, random_state=1, stratify=stratify)
+        train_ind, val_ind = np.sort(train_ind), np.sort(val_ind)
+    else:
+        # too few samples to hold any out: stop on the training loss instead, within
+        # MLPClassifier's default max_iter
+        train_ind, val_ind = np.arange(n), None
+        max_epochs = min(max_epochs, 200)
+    batch = min(batch, train_ind.shape[0])
+    n_steps = int(np.ceil(train_ind.shape[0] / batch))
+
+    # one pass over the training batches for the scaler
+    scaler = StandardScaler()
+    for s in range(0, train_ind.shape[0], batch):
+        scaler.partial_fit(training_data[train_ind[s:s+batch]])
+
+    if n_val > 0:
+        X_val = scaler.transform(training_data[val_ind])
+        y_val = training_labels[val_ind]
+
+    mlp = MLPClassifier(solver='adam', alpha=1, random_state=1, hidden_layer_sizes=[100, 60])
+
+    best_score, best_params, no_change = -np.inf, None, 0
+    for epoch in range(max_epochs):
+        for _ in range(n_steps):
+            ind = np.sort(rng.choice(train_ind, size=batch, replace=False))
+            mlp.partial_fit(scaler.transform(training_data[ind]),
+                            training_labels[ind], classes=unique_labels)
+            for c in mlp.coefs_ + mlp.intercepts_:
+                c[np.abs(c) < tiny] = 0
+
+        if n_val > 0:
+            score = mlp.score(X_val, y_val)
+            if score > best_score:
+                best_params = ([c.copy() for c in mlp.coefs_], [i.copy() for i in mlp.intercepts_])
+        else:
+            score = -mlp.loss_
+        if score < best_score + tol:
+            no_change += 1
+        else:
+            no_change = 0
+        best_score = max(score, best_score)
+
+        if no_change > n_iter_no_change:
+            logging.info('MLP score did not improve for %i epochs, stopping after %i epochs' % (n_iter_no_change, epoch+1))
+            break
+
+    if best_params is not None:
+        mlp.coefs_, mlp.intercepts_ = best_params
+
+    return make_pipeline(scaler, mlp)
+
+##========================================================
+def _onnx_session(clf, training_data):
+    """
+    Convert a fitted classifier to ONNX and return an onnxruntime inference session,
+    or None if skl2onnx/onnxruntime are not installed or the conversion fails
+    """
+    if ort is None:
+        return None
+    try:
+        onx = to_onnx(clf, training_data[:1].astype(np.float32), options={MLPClassifier: {'zipmap': False}})
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess = ort.InferenceSession(onx.SerializeToString(), sess_options, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        logging.info('ONNX conversion failed (%s), predicting with scikit-learn' % (e))
+        return None
+    logging.info('MLP model converted to ONNX')
+    return sess
 
 ##========================================================
 def do_classify(img,mask,n_sigmas,multichannel,intensity,edges,texture,sigma_min,sigma_max, downsample_value):
@@ -468,64 +697,69 @@ def do_classify(img,mask,n_sigmas,multichannel,intensity,edges,texture,sigma_min
 
     if mask is None:
         raise ValueError("If no classifier clf is passed, you must specify a mask.")
-    training_data = features[:, mask > 0].T
-
-    training_data = memmap_feats(training_data)
+    # (n_feats, H*W) view of the feature stack, no copy
+    features_view = features.reshape((features.shape[0], -1))
 
-    training_labels = mask[mask > 0].ravel()
+    # subsample the doodled pixels before gathering them, so only the training rows are copied.
+    # Features are stored as float16, but the MLP is fit in float64: in float32 the L2 penalty
+    # (alpha=1) decays unused weights into denormals, which slow the fit down several times
+    training_ind = np.flatnonzero(mask > 0)[::downsample_value]
 
-    training_data = training_data[::downsample_value]
-    training_labels = training_labels[::downsample_value]
+    # more rows than this only slow the fit down without improving the model
+    lim_samples = 100000
 
-    unique_labels = np.unique(training_labels)
-
-    lim_samples = 100000 #200000
-
-    if training_data.shape[0]>lim_samples:
+    if training_ind.shape[0]>lim_samples:
         logging.info('Number of samples exceeds %i'% lim_samples)
-        ind = np.round(np.linspace(0,training_data.shape[0]-1,lim_samples)).astype('int')
-        training_data = training_data[ind,:]
-        training_labels = training_labels[ind]
+        training_ind = np.sort(np.random.default_rng(1).choice(training_ind, size=lim_samples, replace=False))
         logging.info('Samples have been subsampled')
-        logging.info('Number of samples in training data: %i' % (training_data.shape[0]))
-        print(training_data.shape)
-
-    clf = make_pipeline(
-            StandardScaler(),
-            MLPClassifier(
-                solver='adam', alpha=1, random_state=1, max_iter=2000,
-                early_stopping=True, hidden_layer_sizes=[100, 60],
-            ))
-    logging.info('Initializing MLP model')
 
-    clf.fit(training_data, training_labels)
-    logging.info('MLP model fit to data')
-
-    del training_data, training_labels
+    training_data = np.ascontiguousarray(features_view[:, training_ind].T, dtype=np.float64)
+    training_labels = mask.ravel()[training_ind]
 
-    # use model in predictive mode
-    sh = features.shape
-    features_use = features.reshape((sh[0], np.prod(sh[1:]))).T
+    unique_labels = np.unique(training_labels)
 
-    sh = features_use.shape
+    logging.info('Number of samples in training data: %i' % (training_data.shape[0]))
+    logging.info('Initializing MLP model')
 
-    result = clf.predict_proba(features_use)
+    clf = _fit_mlp(training_data, training_labels, unique_labels)
+    logging.info('MLP model fit to data')
 
-    result = result.reshape((sh[0],)+(len(unique_labels),))
+    sess = _onnx_session(clf, training_data)
 
-    sh = result.shape
+    del training_data, training_labels, training_ind
 
-    result2 = result.copy()
-    del result
+    # use model in predictive mode, streaming blocks of pixels from the feature stack;
+    # features are stored as float16, so each block is cast to a contiguous float32 (pixels, n_feats) array
+    n_pixels = features_view.shape[1]
+    result = np.empty((n_pixels, len(unique_labels)), dtype=np.float32)
+    for s in range(0, n_pixels, PREDICT_CHUNK_SIZE):
+        chunk = np.ascontiguousarray(features_view[:, s:s+PREDICT_CHUNK_SIZE].T, dtype=np.float32)
+        if sess is None:
+            result[s:s+PREDICT_CHUNK_SIZE] = clf.predict_proba(chunk)
+        else:
+            # outputs are [labels, probabilities]
+            result[s:s+PREDICT_CHUNK_SIZE] = sess.run(None, {sess.get_inputs()[0].name: chunk})[1]
 
     # logging.info(datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
     logging.info('RF feature extraction and model fitting complete')
     logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
 
-    return result2, unique_labels
+    return result, unique_labels
 
     # gt_prob,
 
+##========================================================
+def _recode_labels(label, uniq_doodles):
+    """
+    Recodes the (sorted) unique values of a label image to the (sorted) classes present in the doodles,
+    in order, using a single lookup-table gather. Label values left over are coded 0
+    """
+    uniq_label = np.unique(label)
+    k = min(len(uniq_label), len(uniq_doodles))
+    lut = np.zeros(uniq_label.max()+1, dtype=label.dtype)
+    lut[uniq_label[:k]] = uniq_doodles[:k]
+    return lut[label]
+
 # ##========================================================
 def segmentation(
     img, mask,
@@ -557,10 +791,12 @@ def segmentation(
     for ni in np.unique(mask[1:]):
         logging.info('examples provided of %i' % (ni))
 
-    if len(np.unique(mask)[1:])==1:
+    uniq_doodles = np.unique(mask)[1:]
+
+    if len(uniq_doodles)==1:
 
-        logging.info('Only one class annotation provided, skipping MLP and CRF and coding all pixels %i' % (np.unique(mask)[1:]))
-        crf_result = np.ones(mask.shape[:2])*np.unique(mask)[1:]
+        logging.info('Only one class annotation provided, skipping MLP and CRF and coding all pixels %i' % (uniq_doodles))
+        crf_result = np.ones(mask.shape[:2])*uniq_doodles
         crf_result = crf_result.astype(np.uint8)
         logging.info('label creation complete')
 
@@ -568,7 +804,7 @@ def segmentation(
 
         #================================
         # MLP analysis
-        n=len(np.unique(mask)[1:])
+        n=len(uniq_doodles)
 
         mlp_result, unique_labels = do_classify(img,mask,n, #n_sigmas,
                                                 multichannel,intensity,edges,
@@ -581,20 +817,13 @@ def segmentation(
 
         mlp_result = np.argmax(mlp_result,-1)+1
 
-        uniq_doodles = np.unique(mask)[1:]
-        uniq_mlp = np.unique(mlp_result)
-        mlp_result2 = np.zeros_like(mlp_result)
-        for o,e in zip(uniq_doodles,uniq_mlp):
-            mlp_result2[mlp_result==e] = o
-
-        mlp_result = mlp_result2.copy()-1
+        mlp_result = _recode_labels(mlp_result, uniq_doodles)-1
         # print(np.unique(mlp_result))
         logging.info('MLP result recoded to set of classes present in the doodles')
 
-        # make a limited one-hot array and add the available bands
-        nx, ny = mlp_result.shape
-        mlp_result_softmax = np.zeros((nx,ny,n))
-        mlp_result_softmax[:,:,:n] = (np.arange(n) == 1+mlp_result[...,None]-1).astype(int)
+        # make a limited one-hot array by gathering rows of an identity matrix
+        # (rows past n are all zero, so labels outside 0..n-1, including -1, get no class)
+        mlp_result_softmax = np.eye(max(n, mlp_result.max()+1)+1, n, dtype=np.float32)[mlp_result]
 
         # if not np.all(uniq_doodles-1==np.unique(np.argmax(mlp_result_softmax,-1))):
         if not n==len(np.unique(np.argmax(mlp_result_softmax,-1))):
@@ -609,14 +838,9 @@ def segmentation(
                 logging.info('CRF model applied with theta=%f and mu=%f' % ( crf_theta_slider_value, crf_mu_slider_value))
                 logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
 
-                uniq_crf = np.unique(crf_result)
-                crf_result2 = np.zeros_like(crf_result)
-                for o,e in zip(uniq_doodles,uniq_crf):
-                    crf_result2[crf_result==e] = o
+                crf_result = _recode_labels(crf_result, uniq_doodles)-1
                 logging.info('CRF result recoded to set of classes present in the doodles')
 
-                crf_result = crf_result2.copy()-1
-
             except:
                 crf_result = mlp_result.copy()
         else:
@@ -625,16 +849,13 @@ def segmentation(
             # print('CRF ...')
             try:
                 logging.info('CRF from MLP softmax scores being computed')                
+                # bilateral features of the downsampled image, shared with the retry from the doodles below
+                feats = _build_bilateral(img, crf_theta_slider_value, crf_downsample_factor)
                 crf_result, _ = crf_refine(mlp_result_softmax, img, n,
                                         crf_theta_slider_value, crf_mu_slider_value,
-                                        crf_downsample_factor)
-
-                uniq_crf = np.unique(crf_result)
-                crf_result2 = np.zeros_like(crf_result)
-                for o,e in zip(uniq_doodles,uniq_crf):
-                    crf_result2[crf_result==e] = o
+                                        crf_downsample_factor, feats=feats)
 
-                crf_result = crf_result2.copy()-1
+                crf_result = _recode_labels(crf_result, uniq_doodles)-1
                 logging.info('CRF result recoded to set of classes present in the doodles')
 
                 # if not np.all(uniq_doodles-1==np.unique(crf_result)):
@@ -646,17 +867,12 @@ def segmentation(
 
                     crf_result, _ = crf_refine_from_integer_labels(mask, img, n,
                                                                     crf_theta_slider_value, crf_mu_slider_value, 
-                                                                    crf_downsample_factor)
+                                                                    crf_downsample_factor, feats=feats)
 
                     logging.info('CRF model applied with theta=%f and mu=%f' % ( crf_theta_slider_value, crf_mu_slider_value))
                     logging.info('percent RAM usage: %f' % (psutil.virtual_memory()[2]))
 
-                    uniq_crf = np.unique(crf_result)
-                    crf_result2 = np.zeros_like(crf_result)
-                    for o,e in zip(uniq_doodles,uniq_crf):
-                        crf_result2[crf_result==e] = o
-
-                    crf_result = crf_result2.copy()-1
+                    crf_result = _recode_labels(crf_result, uniq_doodles)-1
                     logging.info('CRF result recoded to set of classes present in the doodles')
 
             except: